@@ -24,81 +24,117 @@ Note: All annotators except CannyDetector support specifying a custom device.
 
 import rp
 import sys
+import hashlib
 import functools
+import importlib
+import collections
+import numpy as np
 
 # This codebase's imports assume the ControlNet repo is the root
-sys.path.append(rp.get_parent_directory(__file__, 2))
-
-# Import all annotator functions
-from .canny import CannyDetector
-from .hed import HEDdetector, nms
-from .midas import MidasDetector
-from .openpose import OpenposeDetector
-from .uniformer import UniformerDetector
-from .mlsd import MLSDdetector #Not used right now!
+_repo_root = rp.get_parent_directory(__file__, 2)
+if _repo_root not in sys.path:
+    sys.path.append(_repo_root)
+
+# The annotators are imported lazily, when first accessed, because some of them pull in heavy dependencies.
+# For example, UniformerDetector loads mmseg and mmcv, which you shouldn't have to pay for just to use CannyDetector.
+_LAZY = {
+    'CannyDetector'    : ('.canny'    , 'CannyDetector'    ),
+    'HEDdetector'      : ('.hed'      , 'HEDdetector'      ),
+    'nms'              : ('.hed'      , 'nms'              ),
+    'MidasDetector'    : ('.midas'    , 'MidasDetector'    ),
+    'MLSDdetector'     : ('.mlsd'     , 'MLSDdetector'     ), #Not used right now!
+    'OpenposeDetector' : ('.openpose' , 'OpenposeDetector' ),
+    'UniformerDetector': ('.uniformer', 'UniformerDetector'),
+}
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    module, attr = _LAZY[name]
+    value = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = value # Later lookups are plain attribute hits and skip __getattr__
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
 
 # Define all available annotators
 __all__ = [
     'run_hed',
     'run_midas',
     'run_midas_normals',
+    'run_midas_depth_and_normals',
     'run_openpose',
     'run_uniformer',
 ]
 
-def _is_divisible_by_patch_size(image, patch_size):
-    """Private helper to check if image dimensions are divisible by patch_size"""
-    dims = rp.get_image_dimensions(image)
-    return all(dim % patch_size == 0 for dim in dims)
-
-def _round_to_nearest_patch_size(patch_size=32):
-    """Decorator that ensures image dimensions are multiples of patch_size during processing, but restores the image size afterwards"""
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(image, device=None, **kwargs):
-            original_dims = rp.get_image_dimensions(image)
-
-            # If already divisible, just run the function
-            if _is_divisible_by_patch_size(image, patch_size):
-                return func(image, device, **kwargs)
-
-            # Otherwise resize, process, and resize back
-            target_dims = tuple(x - x % patch_size for x in original_dims)
-            resized_image = rp.cv_resize_image(image, target_dims)
-            result = func(resized_image, device, **kwargs)
-            return rp.cv_resize_image(result, original_dims)
-
-        return wrapper
-    return decorator
+def _hed_nms(edges, threshold, sigma):
+    """Private helper that applies run_hed's non-maximum-suppression to raw HED edges"""
+    from .hed import nms
+    return nms(edges, threshold*255, sigma)
 
 def run_hed(image, device=None, *, threshold=None, sigma=None):
     """
     Runs HED edges on an image as defined by rp.is_image and returns a numpy image.
+    Also accepts a list of same-sized images, which are run in a single batched forward pass and returned as a list.
     Set 0<=threshold<=1 and sigma>=0 for nonmaximum suppression.
     Set device to use a specific GPU of your choice, otherwise it will choose automatically.
     """
     assert (threshold is None) == (sigma is None), 'Either specify both threshold AND sigma for non-maximum-suppression, or dont specify either one'
+    from .hed import HEDdetector
     output = HEDdetector(device)(image)
     if threshold is not None and sigma is not None:
-        output = nms(output, threshold*255, sigma)
+        if isinstance(output, list):
+            output = [_hed_nms(x, threshold, sigma) for x in output]
+        else:
+            output = _hed_nms(output, threshold, sigma)
     return output
 
-@_round_to_nearest_patch_size(32)
+def _run_midas_detector(image, device=None):
+    """Private helper that runs one MIDAS forward pass, returning both (depth, normals)"""
+    from .midas import MidasDetector
+    return MidasDetector(device)(image)
+
+_midas_cache = collections.OrderedDict()
+_MIDAS_CACHE_SIZE = 4
+
+def run_midas_depth_and_normals(image, device=None):
+    """
+    Runs MIDAS monocular depth estimation on an image as defined by rp.is_image and returns a (depth, normals) tuple of numpy images.
+    This only runs the network once. The last few results are cached by image contents, so calling
+    run_midas and run_midas_normals on the same image also only runs the network once.
+    Set device to use a specific GPU of your choice, otherwise it will choose automatically.
+    """
+    image = np.ascontiguousarray(image)
+    key = (device, image.shape, image.dtype.str, hashlib.sha1(image).digest())
+
+    if key in _midas_cache:
+        _midas_cache.move_to_end(key)
+    else:
+        output = _run_midas_detector(image, device)
+        for x in output:
+            x.setflags(write=False) # The cached arrays must never change
+        _midas_cache[key] = output
+        if len(_midas_cache) > _MIDAS_CACHE_SIZE:
+            _midas_cache.popitem(last=False)
+
+    # Callers get their own copies, so editing them in place can't corrupt the cache
+    return tuple(x.copy() for x in _midas_cache[key])
+
 def run_midas(image, device=None):
     """
     Runs MIDAS monocular depth estimation on an image as defined by rp.is_image and returns a numpy image.
     Set device to use a specific GPU of your choice, otherwise it will choose automatically.
     """
-    depth, normals = MidasDetector(device)(image)
+    depth, normals = run_midas_depth_and_normals(image, device)
     return depth
 
-@_round_to_nearest_patch_size(32)
 def run_midas_normals(image, device=None):
     """
     Estimates image normals via MIDAS monocular depth estimation on an image as defined by rp.is_image and returns a numpy image.
     Set device to use a specific GPU of your choice, otherwise it will choose automatically.
     """
-    depth, normals = MidasDetector(device)(image)
+    depth, normals = run_midas_depth_and_normals(image, device)
     return normals
 
 def run_openpose(image, device=None, *, hands=False):
@@ -106,14 +142,17 @@ def run_openpose(image, device=None, *, hands=False):
     Estimates the pose of people in an image, optionally with their hands too on a given image as defined by rp.is_image. Returns an RGB numpy image.
     Set device to use a specific GPU of your choice, otherwise it will choose automatically.
     """
+    from .openpose import OpenposeDetector
     return OpenposeDetector(device)(image, hand=hands)[0]
 
-def run_uniformer(image, device=None):
+def run_uniformer(image, device=None, *, return_tensor=False):
     """
     Returns a segmentation map as an RGB numpy image from a given image as defined by rp.is_image.
+    If return_tensor is True, returns it as an HxWx3 uint8 torch tensor on the device instead.
     Set device to use a specific GPU of your choice, otherwise it will choose automatically.
     """
-    return UniformerDetector(device)(image)
+    from .uniformer import UniformerDetector
+    return UniformerDetector(device)(image, return_tensor=return_tensor)
 
 def run_annotator_demo(*images):
     """ Run this function as-is to demo the annotator """
@@ -141,11 +180,13 @@ def run_annotator_demo(*images):
         append(run_uniformer    (image                       ), 'run_uniformer'                )
         append(run_openpose     (image                       ), 'run_openpose'                 )
         append(run_openpose     (image, hands=True           ), 'run_openpose hands=True'      )
-        append(run_midas_normals(image                       ), 'run_midas_normals'            )
-        append(run_midas        (image                       ), 'run_midas'                    )
-        append(run_hed          (image, threshold=10, sigma=5), 'run_hed threshold=.1,sigma=10')
-        append(run_hed          (image, threshold= 0, sigma=5), 'run_hed threshold=.5,sigma= 0')
-        append(run_hed          (image                       ), 'run_hed'                      )
+        depth, normals = run_midas_depth_and_normals(image)
+        append(normals                                        , 'run_midas_normals'            )
+        append(depth                                          , 'run_midas'                    )
+        hed = run_hed(image) # One HED forward pass, post-processed three ways
+        append(_hed_nms         (hed  , threshold=10, sigma=5), 'run_hed threshold=.1,sigma=10')
+        append(_hed_nms         (hed  , threshold= 0, sigma=5), 'run_hed threshold=.5,sigma= 0')
+        append(hed                                            , 'run_hed'                      )
         append(rp.auto_canny    (image                       ), 'rp.auto_canny'                )
         append(rp.auto_canny    (rp.cv_box_blur(image, 5)    ), 'rp.auto_canny box-sigma=5'    )
         append(rp.auto_canny    (rp.cv_box_blur(image,10)    ), 'rp.auto_canny box-sigma=10'   )
@@ -1,7 +1,12 @@
 import cv2
+import numpy as np
+import rp
 
 
 class CannyDetector:
     def __call__(self, img, low_threshold, high_threshold):
-        img = rp.as_byte_image(rp.as_rgb_image(img))
+        # cv2.Canny takes 8-bit grayscale or RGB directly, so those don't need converting
+        is_byte_gray_or_rgb = isinstance(img, np.ndarray) and img.dtype == np.uint8 and (img.ndim == 2 or img.ndim == 3 and img.shape[2] == 3)
+        if not is_byte_gray_or_rgb:
+            img = rp.as_byte_image(rp.as_rgb_image(img))
         return cv2.Canny(img, low_threshold, high_threshold)
@@ -5,13 +5,15 @@
 # Different from official models and other implementations, this is an RGB-input model (rather than BGR)
 # and in this way it works better for gradio's RGB protocol
 
+import functools
+import threading
 import os
 import cv2
 import torch
 import numpy as np
 
 from einops import rearrange
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, PinnedUploader, compile_model, freeze_model, warm_up_model, to_inference_dtype, inference_autocast
 import rp
 
 
@@ -24,7 +26,7 @@ class DoubleConvBlock(torch.nn.Module):
             self.convs.append(torch.nn.Conv2d(in_channels=output_channel, out_channels=output_channel, kernel_size=(3, 3), stride=(1, 1), padding=1))
         self.projection = torch.nn.Conv2d(in_channels=output_channel, out_channels=1, kernel_size=(1, 1), stride=(1, 1), padding=0)
 
-    def __call__(self, x, down_sampling=False):
+    def forward(self, x, down_sampling: bool = False):
         h = x
         if down_sampling:
             h = torch.nn.functional.max_pool2d(h, kernel_size=(2, 2), stride=(2, 2))
@@ -44,7 +46,7 @@ class ControlNetHED_Apache2(torch.nn.Module):
         self.block4 = DoubleConvBlock(input_channel=256, output_channel=512, layer_number=3)
         self.block5 = DoubleConvBlock(input_channel=512, output_channel=512, layer_number=3)
 
-    def __call__(self, x):
+    def forward(self, x):
         h = x - self.norm
         h, projection1 = self.block1(h)
         h, projection2 = self.block2(h, down_sampling=True)
@@ -64,23 +66,44 @@ class _HEDdetector(rp.CachedInstances):
             load_file_from_url(remote_model_path, model_dir=annotator_ckpts_path)
         self.netNetwork = ControlNetHED_Apache2().float().to(device).eval()
         self.netNetwork.load_state_dict(torch.load(modelpath))
+        self.netNetwork = to_inference_dtype(self.netNetwork, device)
+        self.netNetwork = freeze_model(self.netNetwork, device)
+        self.netNetwork = compile_model(self.netNetwork)
+        warm_up_model(self.netNetwork, device)
+        self.upload = PinnedUploader(device)
+        self.resize_scratch = threading.local() # Per-thread, since this detector instance is shared
 
     def __call__(self, input_image):
-        input_image = rp.as_byte_image(rp.as_rgb_image(input_image))
-        assert input_image.ndim == 3
-        H, W, C = input_image.shape
-        with torch.no_grad():
-            image_hed = torch.from_numpy(input_image.copy()).float().to(self.device)
-            image_hed = rearrange(image_hed, 'h w c -> 1 c h w')
-            edges = self.netNetwork(image_hed)
-            edges = [e.detach().cpu().numpy().astype(np.float32)[0, 0] for e in edges]
-            edges = [cv2.resize(e, (W, H), interpolation=cv2.INTER_LINEAR) for e in edges]
-            edges = np.stack(edges, axis=2)
-            edge = 1 / (1 + np.exp(-np.mean(edges, axis=2).astype(np.float64)))
-            edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
-            return edge
+        """Runs on one image, or on a list of same-sized images in a single batched forward pass, returning a list"""
+        if isinstance(input_image, (list, tuple)):
+            return self._run_batch(input_image)
+        return self._run_batch([input_image])[0]
+
+    def _run_batch(self, input_images):
+        input_images = [rp.as_byte_image(rp.as_rgb_image(x)) for x in input_images]
+        assert all(x.ndim == 3 for x in input_images)
+        H, W, C = input_images[0].shape
+        assert all(x.shape == (H, W, C) for x in input_images), 'All images in a batch must have the same shape'
+        with torch.inference_mode(), inference_autocast(self.device):
+            image_hed = self.upload(np.stack(input_images)).float()
+            image_hed = rearrange(image_hed, 'n h w c -> n c h w')
+            batch_edges = self.netNetwork(image_hed)
+            batch_edges = [e.detach().float().cpu().numpy()[:, 0] for e in batch_edges]
+            output = []
+            # The side outputs are resized straight into a reused buffer, instead of allocating and stacking them each time
+            edges = getattr(self.resize_scratch, 'edges', None)
+            if edges is None or edges.shape != (len(batch_edges), H, W):
+                edges = self.resize_scratch.edges = np.empty((len(batch_edges), H, W), dtype=np.float32)
+            for i in range(len(input_images)):
+                for e, dst in zip(batch_edges, edges):
+                    cv2.resize(e[i], (W, H), dst=dst, interpolation=cv2.INTER_LINEAR)
+                edge = 1 / (1 + np.exp(-np.mean(edges, axis=0).astype(np.float64)))
+                edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
+                output.append(edge)
+            return output
 
 _device = None
+@functools.lru_cache(maxsize=None)
 def HEDdetector(device=None):
     global _device
     if device is None:
@@ -98,11 +121,10 @@ def nms(x, t, s):
     f3 = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=np.uint8)
     f4 = np.array([[0, 0, 1], [0, 1, 0], [1, 0, 0]], dtype=np.uint8)
 
-    y = np.zeros_like(x)
-
+    # A pixel survives if it's a local maximum along any of the four directions
+    keep = np.zeros(x.shape, dtype=bool)
     for f in [f1, f2, f3, f4]:
-        np.putmask(y, cv2.dilate(x, kernel=f) == x, x)
+        keep |= cv2.dilate(x, kernel=f) == x
 
-    z = np.zeros_like(y, dtype=np.uint8)
-    z[y > t] = 255
-    return z
+    y = np.where(keep, x, 0)
+    return (y > t).astype(np.uint8) * 255
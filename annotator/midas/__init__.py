@@ -2,29 +2,46 @@
 # From https://github.com/isl-org/MiDaS
 # MIT LICENSE
 
+import functools
 import cv2
 import numpy as np
 import torch
 
 from einops import rearrange
 from .api import MiDaSInference
+from annotator.util import PinnedUploader, compile_model, freeze_model, warm_up_model
 import rp
 
 
 class _MidasDetector(rp.CachedInstances):
+    patch_size = 32 # DPT needs image dimensions that are multiples of this
+
     def __init__(self, device):
         self.device = device
+        # MIDAS stays in float32: its depth reaches the thousands, where bfloat16 steps would posterize the Sobel normals
         self.model = MiDaSInference(model_type="dpt_hybrid").to(device)
+        self.model = freeze_model(self.model, device)
+        self.model = compile_model(self.model)
+        warm_up_model(self.model, device, autocast=False)
+        self.upload = PinnedUploader(device)
 
     def __call__(self, input_image, a=np.pi * 2.0, bg_th=0.1):
         assert input_image.ndim == 3
         input_image = rp.as_byte_image(rp.as_rgb_image(input_image))
+        H, W, C = input_image.shape
+
+        # Reflect-pad to multiples of patch_size. Since patch_size is a power of two, a bitmask checks both dims at once.
+        # Padding only touches the borders, unlike resizing to fit and back.
+        if (H | W) & (self.patch_size - 1):
+            input_image = cv2.copyMakeBorder(input_image, 0, -H % self.patch_size, 0, -W % self.patch_size, cv2.BORDER_REFLECT_101)
+
         image_depth = input_image
-        with torch.no_grad():
-            image_depth = torch.from_numpy(image_depth).float().to(self.device)
+        with torch.inference_mode():
+            image_depth = self.upload(image_depth).float()
             image_depth = image_depth / 127.5 - 1.0
             image_depth = rearrange(image_depth, 'h w c -> 1 c h w')
-            depth = self.model(image_depth)[0]
+            # Crop off the padding before normalizing, so the depth range and background mask only see the actual image
+            depth = self.model(image_depth)[0][:H, :W].contiguous()
 
             depth_pt = depth.clone()
             depth_pt -= torch.min(depth_pt)
@@ -46,6 +63,7 @@ class _MidasDetector(rp.CachedInstances):
 
 
 _device = None
+@functools.lru_cache(maxsize=None)
 def MidasDetector(device=None):
     global _device
     if device is None:
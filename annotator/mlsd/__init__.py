@@ -36,7 +36,7 @@ class _MLSDdetector(rp.CachedInstances):
         img = input_image
         img_output = np.zeros_like(img)
         try:
-            with torch.no_grad():
+            with torch.inference_mode():
                 lines = pred_lines(img, self.model, [img.shape[0], img.shape[1]], thr_v, thr_d)
                 for line in lines:
                     x_start, y_start, x_end, y_end = [int(val) for val in line]
@@ -3,6 +3,7 @@
 # 2nd Edited by https://github.com/Hzzone/pytorch-openpose
 # 3rd Edited by ControlNet
 
+import functools
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
@@ -11,7 +12,7 @@ import numpy as np
 from . import util
 from .body import Body
 from .hand import Hand
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, compile_model, freeze_model, warm_up_model, to_inference_dtype, inference_autocast
 import rp
 
 
@@ -32,11 +33,16 @@ class _OpenposeDetector(rp.CachedInstances):
 
         self.body_estimation = Body(body_modelpath, device)
         self.hand_estimation = Hand(hand_modelpath, device)
+        for estimation in [self.body_estimation, self.hand_estimation]:
+            estimation.model = to_inference_dtype(estimation.model, device)
+            estimation.model = freeze_model(estimation.model, device)
+            estimation.model = compile_model(estimation.model)
+            warm_up_model(estimation.model, device)
 
     def __call__(self, oriImg, hand=False):
         oriImg = rp.as_byte_image(rp.as_rgb_image(oriImg))
         oriImg = oriImg[:, :, ::-1].copy()
-        with torch.no_grad():
+        with torch.inference_mode(), inference_autocast(self.device):
             candidate, subset = self.body_estimation(oriImg)
             canvas = np.zeros_like(oriImg)
             canvas = util.draw_bodypose(canvas, candidate, subset)
@@ -53,6 +59,7 @@ class _OpenposeDetector(rp.CachedInstances):
 
 
 _device = None
+@functools.lru_cache(maxsize=None)
 def OpenposeDetector(device=None):
     global _device
     if device is None:
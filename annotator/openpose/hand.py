@@ -43,7 +43,7 @@ class Hand(object):
             data = data.to(self.device)
             # data = data.permute([2, 0, 1]).unsqueeze(0).float()
             with torch.no_grad():
-                output = self.model(data).cpu().numpy()
+                output = self.model(data).float().cpu().numpy()
                 # output = self.model(data).numpy()q
 
             # extract outputs, resize, and remove padding
@@ -2,11 +2,14 @@
 # From https://github.com/Sense-X/UniFormer
 # # Apache-2.0 license
 
+import functools
 import os
+import numpy as np
+import torch
 
-from annotator.uniformer.mmseg.apis import init_segmentor, inference_segmentor, show_result_pyplot
+from annotator.uniformer.mmseg.apis import init_segmentor, inference_segmentor
 from annotator.uniformer.mmseg.core.evaluation import get_palette
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, compile_model, freeze_model, warm_up_model, get_trt_model, to_inference_dtype, inference_autocast
 import rp
 
 
@@ -22,15 +25,45 @@ class _UniformerDetector(rp.CachedInstances):
             load_file_from_url(checkpoint_file, model_dir=annotator_ckpts_path)
         config_file = os.path.join(os.path.dirname(annotator_ckpts_path), "uniformer", "exp", "upernet_global_small", "config.py")
         self.model = init_segmentor(config_file, modelpath).to(device)
+        self.model = to_inference_dtype(self.model, device)
 
-    def __call__(self, img):
+        # Only compile the backbone: inference_segmentor and show_result need the segmentor's own attributes and methods
+        # The test pipeline rescales images to fit in 2048x512 (keeping aspect ratio), so the engine takes a range of shapes
+        # Very wide or tall images can come out smaller than min_shape, and those fall back to the original backbone
+        self.model.backbone = get_trt_model(
+            self.model.backbone,
+            example_inputs=torch.zeros(1, 3, 512, 512, device=device),
+            cache_path=os.path.join(annotator_ckpts_path, "upernet_global_small_backbone_trt.ts"),
+            min_shape=(1, 3, 128, 128),
+            max_shape=(1, 3, 2048, 2048),
+        )
+        self.model.backbone = freeze_model(self.model.backbone, device)
+        self.model.backbone = compile_model(self.model.backbone)
+        warm_up_model(self.model.backbone, device)
+
+        # Maps class indices straight to RGB colors, like show_result_pyplot does
+        self.palette_lut = np.asarray(get_palette('ade'), dtype=np.uint8)
+        self.device_palette_lut = None
+
+    def __call__(self, img, return_tensor=False):
         img = rp.as_byte_image(rp.as_rgb_image(img))
-        result = inference_segmentor(self.model, img)
-        res_img = show_result_pyplot(self.model, img, result, get_palette('ade'), opacity=1)
-        return res_img
+        with torch.inference_mode(), inference_autocast(self.device):
+            result = inference_segmentor(self.model, img)
+        seg = result[0]
+        if return_tensor:
+            return self._colorize_on_device(seg)
+        return self.palette_lut[seg]
+
+    def _colorize_on_device(self, seg):
+        # Uploads the class map as one byte per pixel and colors it on the device
+        if self.device_palette_lut is None:
+            self.device_palette_lut = torch.as_tensor(self.palette_lut, device=self.device)
+        seg = torch.from_numpy(seg.astype(np.uint8)).to(self.device)
+        return self.device_palette_lut[seg.long()]
 
 
 _device = None
+@functools.lru_cache(maxsize=None)
 def UniformerDetector(device=None):
     global _device
     if device is None:
@@ -1,10 +1,197 @@
 import numpy as np
 import cv2
 import os
+import re
+import copy
+import torch
+import functools
+import threading
+import warnings
 
 
 annotator_ckpts_path = os.path.join(os.path.dirname(__file__), 'ckpts')
 
+# Set to True before constructing any detectors to torch.compile their networks.
+# It's opt-in because compiling makes the first call to each detector much slower.
+COMPILE_MODELS = False
+
+# Set to True before constructing any detectors to use TensorRT engines where supported.
+# Engines are built once and cached next to the checkpoints. Requires torch_tensorrt.
+USE_TENSORRT = False
+
+# Set to True before constructing any detectors to turn on torch.backends.cudnn.benchmark, process-wide.
+# It's opt-in because cudnn re-autotunes for every new input shape, and most annotators see shapes that keep changing.
+# It only pays off when feeding same-sized images, such as video frames.
+CUDNN_BENCHMARK = False
+
+
+def compile_model(model):
+    # TorchScript modules and TensorRT engines are already compiled
+    if COMPILE_MODELS and hasattr(torch, "compile") and not isinstance(model, (torch.jit.ScriptModule, TensorRTWithFallback)):
+        return torch.compile(model, mode="reduce-overhead", fullgraph=False)
+    return model
+
+
+def freeze_model(model, device):
+    """
+    Scripts, freezes and optimizes model for inference, which inlines its parameters and folds conv+batchnorm pairs.
+    Only done on CPU: the MKLDNN optimizations target CPU, and scripted graphs don't follow the bfloat16 autocast used on GPU.
+    Returns the original model if it can't be scripted.
+    """
+    if is_cuda_device(device) or isinstance(model, torch.jit.ScriptModule):
+        return model
+    try:
+        scripted = torch.jit.script(model.eval())
+        frozen = torch.jit.freeze(scripted)
+        return torch.jit.optimize_for_inference(frozen)
+    except Exception as error:
+        warnings.warn("Could not freeze %s, using it as-is: %s" % (type(model).__name__, error))
+        return model
+
+
+class TensorRTWithFallback(torch.nn.Module):
+    """
+    Runs a TensorRT engine on inputs within the shape range it was built for, and the original model on anything else.
+    """
+    def __init__(self, engine, model, min_shape, max_shape):
+        super().__init__()
+        self.engine = engine
+        self.model = model
+        self.min_shape = min_shape
+        self.max_shape = max_shape
+
+    def forward(self, x):
+        in_range = all(low <= size <= high for low, size, high in zip(self.min_shape, x.shape, self.max_shape))
+        return self.engine(x) if in_range else self.model(x)
+
+
+def get_trt_model(model, example_inputs, cache_path, min_shape=None, max_shape=None):
+    """
+    Returns a TensorRT version of model, loading the engine from disk if it's already been built.
+    The engine takes float32 inputs shaped between min_shape and max_shape, and runs in half precision internally.
+    Inputs outside that range are run by the original model instead.
+    Engines only work with the GPU, TensorRT version and shapes they were built for, so those are added to cache_path's filename.
+    Returns the original model, unmodified, if USE_TENSORRT is off, the inputs aren't on a GPU,
+    torch_tensorrt isn't installed, or the model can't be converted.
+    """
+    if not USE_TENSORRT or not example_inputs.is_cuda:
+        return model
+    try:
+        import torch_tensorrt
+    except ImportError:
+        return model
+
+    shapes = [tuple(min_shape or example_inputs.shape), tuple(example_inputs.shape), tuple(max_shape or example_inputs.shape)]
+    gpu_name = re.sub(r'\W+', '_', torch.cuda.get_device_name(example_inputs.device))
+    shapes_name = '-'.join('x'.join(map(str, shape)) for shape in shapes)
+    cache_root, cache_ext = os.path.splitext(cache_path)
+    cache_path = '%s.%s.trt%s.%s%s' % (cache_root, gpu_name, torch_tensorrt.__version__, shapes_name, cache_ext)
+
+    min_shape, opt_shape, max_shape = shapes
+    if os.path.exists(cache_path):
+        engine = torch.jit.load(cache_path, map_location=example_inputs.device)
+        return TensorRTWithFallback(engine, model, min_shape, max_shape)
+
+    inputs = [torch_tensorrt.Input(min_shape=min_shape, opt_shape=opt_shape, max_shape=max_shape, dtype=torch.float32)]
+    try:
+        # Converts a float32 copy, so the original model is left as-is if this fails
+        float_model = copy.deepcopy(model).float().eval()
+        # ir="ts" builds a TorchScript engine, which is what torch.jit.save and torch.jit.load expect
+        engine = torch_tensorrt.compile(float_model, ir="ts", inputs=inputs, enabled_precisions={torch.half})
+        torch.jit.save(engine, cache_path)
+    except Exception as error:
+        warnings.warn("Could not convert %s to TensorRT, using it as-is: %s" % (type(model).__name__, error))
+        return model
+    return TensorRTWithFallback(engine, model, min_shape, max_shape)
+
+
+def is_cuda_device(device):
+    return torch.device(device).type == "cuda"
+
+
+@functools.lru_cache(maxsize=None)
+def uses_bfloat16(device):
+    # bfloat16 only pays off on GPUs with bfloat16 tensor cores (Ampere and newer). Older GPUs like the T4 and V100 emulate it slowly.
+    if not is_cuda_device(device):
+        return False
+    with torch.cuda.device(device):
+        try:
+            return torch.cuda.is_bf16_supported(including_emulation=False)
+        except TypeError:
+            return torch.cuda.is_bf16_supported() # Older versions of torch don't count emulation, and don't take that argument
+
+
+def to_inference_dtype(model, device):
+    # Where supported, the annotators run in bfloat16: it halves memory traffic and uses tensor cores, without fp16's overflow risk
+    if uses_bfloat16(device):
+        return model.to(torch.bfloat16)
+    return model
+
+
+def inference_autocast(device):
+    return torch.autocast("cuda", dtype=torch.bfloat16, enabled=uses_bfloat16(device))
+
+
+def warm_up_model(model, device, shape=(1, 3, 512, 512), autocast=True):
+    """
+    Runs model twice on a blank input, so torch.compile, TensorRT and cudnn autotuning happen when the detector
+    is constructed instead of during its first real call. The second run is needed by torch.compile's reduce-overhead mode,
+    which only records its CUDA graphs after a warm-up call. Also turns on cudnn.benchmark if CUDNN_BENCHMARK is set.
+    Set autocast=False for models that run in full precision, so they're warmed up the same way they're called.
+    """
+    if CUDNN_BENCHMARK:
+        torch.backends.cudnn.benchmark = True
+    if not (is_cuda_device(device) or COMPILE_MODELS or isinstance(model, (torch.jit.ScriptModule, TensorRTWithFallback))):
+        return # Nothing to warm up
+    try:
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=autocast and uses_bfloat16(device)):
+            dummy_input = torch.zeros(shape, device=device)
+            for _ in range(2):
+                model(dummy_input)
+    except Exception as error:
+        warnings.warn("Could not warm up %s: %s" % (type(model).__name__, error))
+
+
+class PinnedUploader:
+    """
+    Uploads uint8 numpy images to a device through a reusable pinned host buffer, using a dedicated copy stream.
+    The buffer grows to fit the largest image seen so far. On CPU devices it just wraps the array.
+    Thread-safe: detectors are shared process-wide, so uploads from different threads take turns using the buffer.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.buffer = None
+        self.copy_done = None
+        self.stream = torch.cuda.Stream(device) if is_cuda_device(device) else None
+        self.lock = threading.Lock()
+
+    def __call__(self, image):
+        if self.stream is None:
+            return torch.from_numpy(np.ascontiguousarray(image)).to(self.device)
+
+        assert image.dtype == np.uint8
+        with self.lock:
+            return self._upload(image)
+
+    def _upload(self, image):
+        if self.buffer is None or self.buffer.numel() < image.size:
+            self.buffer = torch.empty(image.size, dtype=torch.uint8, pin_memory=True)
+        elif self.copy_done is not None:
+            # Don't overwrite the buffer while the previous upload might still be reading it
+            self.copy_done.synchronize()
+
+        host_image = self.buffer[:image.size].view(image.shape)
+        np.copyto(host_image.numpy(), image)
+
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            device_image = host_image.to(self.device, non_blocking=True)
+            self.copy_done = torch.cuda.Event()
+            self.copy_done.record(self.stream)
+        compute_stream.wait_stream(self.stream)
+        device_image.record_stream(compute_stream)
+        return device_image
+
 
 def HWC3(x):
     assert x.dtype == np.uint8